@@ -3,11 +3,15 @@
 XCP-NG Template Generator
 Generate VM templates for XCP-NG using Xen Orchestra API
 """
+
 import os
 import asyncio
+import contextlib
+import logging
 import sys
-import concurrent.futures
+import threading
 from pathlib import Path
+from typing import Optional
 
 import rich_click as click
 from rich.console import Console
@@ -16,8 +20,9 @@ from rich.table import Table
 from rich.logging import RichHandler
 from rich.live import Live
 
-from pydantic_yaml import parse_yaml_file_as
+import yaml
 
+from services.image_providers import prune_image_cache
 from services.models import TemplateList
 from services.template import TemplateManager
 from services.xen_orchestra import XenOrchestraApi, AsyncAPISession
@@ -37,6 +42,12 @@ click.rich_click.MAX_WIDTH = 100
 # Create a console for rich output
 console = Console()
 
+# Bytes in a GiB, for memory sizes reported by Xen Orchestra
+GIB = 1 << 30
+
+# libyaml-backed loader when available, pure-Python one otherwise
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 # Configure RichHandler for logging - ensure there's only one handler
 if logger.handlers:
     # Clear any existing handlers
@@ -78,29 +89,118 @@ def cli(ctx, verbose):
     ctx.obj["verbose"] = verbose
 
 
-def generate_thread_process(
-    manager: TemplateManager, xoa_host: str, xoa_auth_token: str
-):
+def _load_templates(config_path: Path) -> TemplateList:
     """
-    Generate VM templates in a separate thread.
-    This function is intended to be run in a separate thread to avoid blocking
-    the main event loop.
-    It uses the TemplateManager to generate templates using the Xen Orchestra API.
-    :param manager: TemplateManager instance for generating templates
-    :param xoa_host: Xen Orchestra API host
-    :param xoa_auth_token: Xen Orchestra API authentication token
-    :return: None
+    Load and validate the templates configuration file.
+
+    Args:
+        config_path: Path to the YAML configuration file
+
+    Returns:
+        The validated templates configuration
     """
-    return asyncio.run(_generate_thread_process(manager, xoa_host, xoa_auth_token))
+    config_data = yaml.load(config_path.read_bytes(), Loader=YAML_LOADER)
+    return TemplateList.model_validate(config_data)
 
 
-async def _generate_thread_process(
-    manager: TemplateManager, xoa_host: str, xoa_auth_token: str
-):
-    """Async implementation of generate_thread_process."""
-    api = XenOrchestraApi(host=xoa_host, auth_token=xoa_auth_token)
-    async with AsyncAPISession(api) as session_api:
-        await manager.generate(session_api)
+def _print_error(error: Exception) -> None:
+    """
+    Report a command failure, with its traceback in debug mode (-vv).
+
+    Args:
+        error: Exception that made the command fail
+    """
+    console.print(f"[bold red]Error:[/bold red] {type(error).__name__}: {error}")
+    if logger.isEnabledFor(logging.DEBUG):
+        console.print_exception()
+
+
+def _get_api(xoa_url: str, xoa_token: str) -> Optional[XenOrchestraApi]:
+    """
+    Build the Xen Orchestra API client shared by the commands.
+
+    Args:
+        xoa_url: URL from the command line or the XOA_URL variable (via click)
+        xoa_token: Token from the command line or the XOA_TOKEN variable (via click)
+
+    Returns:
+        The API client, or None if the credentials are missing
+    """
+    if not xoa_url or not xoa_token:
+        console.print(
+            Panel(
+                "[bold red]Error:[/bold red] XOA_URL and XOA_TOKEN must be provided either as command-line options or environment variables",
+                title="Missing Credentials",
+                border_style="red",
+            )
+        )
+        return None
+
+    return XenOrchestraApi(host=xoa_url, auth_token=xoa_token)
+
+
+async def _confirm(text: str, default: bool = False) -> bool:
+    """
+    Ask the user for confirmation without blocking the event loop.
+
+    The prompt runs in a daemon thread rather than in the default executor,
+    which asyncio.run waits for on shutdown: an interrupted run would
+    otherwise hang until the blocked prompt returns.
+
+    Args:
+        text: Question to ask
+        default: Answer when the user just presses enter
+
+    Returns:
+        True if the user confirmed, False if they declined or closed the input
+    """
+    loop = asyncio.get_running_loop()
+    answer = loop.create_future()
+
+    def prompt() -> None:
+        try:
+            result = click.confirm(text, default=default)
+        except click.Abort:
+            # Raised by click on EOF or Ctrl-C, both mean the run is cancelled
+            result = False
+        # The loop is already closed if the run was interrupted meanwhile
+        with contextlib.suppress(RuntimeError):
+            loop.call_soon_threadsafe(
+                lambda: answer.done() or answer.set_result(result)
+            )
+
+    threading.Thread(target=prompt, daemon=True).start()
+    return await answer
+
+
+async def _abandon_session(opening: asyncio.Task, session: AsyncAPISession) -> None:
+    """
+    Stop opening a session, or close it if it is already open.
+
+    Args:
+        opening: Task opening the session
+        session: Session opened by the task
+    """
+    if opening.cancel():
+        with contextlib.suppress(asyncio.CancelledError):
+            await opening
+    elif opening.exception() is None:
+        await session.__aexit__(None, None, None)
+
+
+async def _generate_template(
+    manager: TemplateManager, xo_api: XenOrchestraApi, semaphore: asyncio.Semaphore
+) -> None:
+    """
+    Generate one template once a concurrency slot is free.
+
+    Args:
+        manager: Manager of the template to generate
+        xo_api: Connected API client shared by all templates
+        semaphore: Semaphore bounding the templates generated at once
+    """
+    async with semaphore:
+        await manager.generate(xo_api)
 
 
 @cli.command()
@@ -124,41 +224,67 @@ async def _generate_thread_process(
 @click.option(
     "--concurrency",
     "-j",
-    type=int,
-    default=2,
-    help="Number of concurrent tasks to run [default: 2]",
+    type=click.IntRange(min=1),
+    default=4,
+    envvar="XOA_CONCURRENCY",
+    help="Number of templates to generate concurrently [default: 4] [env var: XOA_CONCURRENCY]",
+)
+@click.option(
+    "--image-cache-size",
+    type=click.FloatRange(min=0),
+    envvar="XOA_IMAGE_CACHE_SIZE",
+    help="Maximum size in GB of the downloaded images cache [default: half of the free disk space] [env var: XOA_IMAGE_CACHE_SIZE]",
 )
 @click.pass_context
-def generate(ctx, config: str, xoa_url: str, xoa_token: str, concurrency):
+def generate(
+    ctx,
+    config: str,
+    xoa_url: str,
+    xoa_token: str,
+    concurrency: int,
+    image_cache_size: Optional[float],
+):
     """
     Generate VM templates from configuration file.
 
     Reads template specifications from the YAML configuration file and creates
     VM templates according to these specifications using Xen Orchestra API.
     """
+    # Run the async function in the event loop
+    return asyncio.run(
+        _generate(
+            config,
+            xoa_url,
+            xoa_token,
+            concurrency,
+            None if image_cache_size is None else int(image_cache_size * GIB),
+        )
+    )
+
+
+async def _generate(
+    config: str,
+    xoa_url: str,
+    xoa_token: str,
+    concurrency: int,
+    image_cache_size: Optional[int] = None,
+):
+    """Async implementation of generate command."""
     try:
-        # XenOrchestra API setup
-        xoa_host = xoa_url or os.getenv("XOA_URL")
-        xoa_auth_token = xoa_token or os.getenv("XOA_TOKEN")
-
-        if not xoa_host or not xoa_auth_token:
-            console.print(
-                Panel(
-                    "[bold red]Error:[/bold red] XOA_URL and XOA_TOKEN must be provided either as command-line options or environment variables",
-                    title="Missing Credentials",
-                    border_style="red",
-                )
-            )
+        api = _get_api(xoa_url, xoa_token)
+        if api is None:
             return 1
 
         multi_task_progress = MultiTaskProgress()
 
-        # Load the configuration file
-        templates = parse_yaml_file_as(TemplateList, Path(config))
+        # Load the configuration file without blocking the event loop
+        templates = await asyncio.to_thread(_load_templates, Path(config))
         templates_managers = [
             TemplateManager(template, multi_task_progress)
             for template in templates.templates.values()
         ]
+        # More slots than templates would only oversize the connection pool
+        concurrency = min(concurrency, max(1, len(templates_managers)))
 
         # Display template information
         table = Table(title="Templates to be Generated")
@@ -176,47 +302,73 @@ def generate(ctx, config: str, xoa_url: str, xoa_token: str, concurrency):
 
         console.print(table)
 
-        if click.confirm(
-            "Do you want to continue with template generation?", default=True
-        ):
+        # A failed handshake is reported once the user has answered, rather
+        # than logged in the middle of the prompt
+        session = AsyncAPISession(api, concurrency=concurrency, log_errors=False)
+        # Connect and log in while the user reads the plan, so the first
+        # calls find an open session
+        prewarm = asyncio.create_task(session.__aenter__())
+
+        try:
+            confirmed = await _confirm(
+                "Do you want to continue with template generation?", default=True
+            )
+        except BaseException:
+            # Interrupted at the prompt, do not leave the session open
+            await _abandon_session(prewarm, session)
+            raise
+
+        if not confirmed:
+            await _abandon_session(prewarm, session)
+            console.print("[yellow]Template generation cancelled.[/yellow]")
+            return 0
+
+        session_api = await prewarm
+        try:
             with Live(
                 multi_task_progress.render(), refresh_per_second=10, console=console
             ) as live:
+                # Templates are independent, so their XO round-trips and
+                # image transfers can overlap up to the concurrency limit
+                semaphore = asyncio.Semaphore(concurrency)
 
-                with concurrent.futures.ThreadPoolExecutor(
-                    max_workers=concurrency
-                ) as executor:
-                    futures = [
-                        executor.submit(
-                            generate_thread_process,
-                            manager,
-                            xoa_host,
-                            xoa_auth_token,
-                        )
+                results = await asyncio.gather(
+                    *(
+                        _generate_template(manager, session_api, semaphore)
                         for manager in templates_managers
-                    ]
-
-                    for future in concurrent.futures.as_completed(futures):
-                        try:
-                            future.result()
-                        except Exception as e:
-                            console.print(
-                                f"[bold red]Error in template generation:[/bold red] {str(e)}"
-                            )
-                        else:
-                            console.print(
-                                "[bold green]Template generated successfully![/bold green]"
-                            )
-
-                console.print(
-                    "[bold green]All templates processed successfully![/bold green]"
+                    ),
+                    return_exceptions=True,
                 )
-        else:
-            console.print("[yellow]Template generation cancelled.[/yellow]")
+
+                for result in results:
+                    if isinstance(result, Exception):
+                        console.print(
+                            f"[bold red]Error in template generation:[/bold red] {str(result)}"
+                        )
+                    else:
+                        console.print(
+                            "[bold green]Template generated successfully![/bold green]"
+                        )
+
+            console.print(
+                "[bold green]All templates processed successfully![/bold green]"
+            )
+
+            # Images of older upstream builds pile up, drop the least recently
+            # used ones once the images of this run are no longer needed
+            try:
+                for image_dir in await asyncio.to_thread(
+                    prune_image_cache, image_cache_size
+                ):
+                    logger.info("Removed cached image: %s", image_dir)
+            except OSError as e:
+                # The templates are generated, do not fail the run for it
+                logger.warning("Could not prune the images cache: %s", e)
+        finally:
+            await session.__aexit__(None, None, None)
 
     except Exception as e:
-        console.print(f"[bold red]Error:[/bold red] {str(e)}")
-        console.print_exception()
+        _print_error(e)
         return 1
 
     return 0
@@ -246,23 +398,12 @@ def list_templates(ctx, xoa_url: str, xoa_token: str):
 async def _list_templates(xoa_url: str, xoa_token: str):
     """Async implementation of list_templates command."""
     try:
-        # XenOrchestra API setup
-        xoa_host = xoa_url or os.getenv("XOA_URL")
-        xoa_auth_token = xoa_token or os.getenv("XOA_TOKEN")
-
-        if not xoa_host or not xoa_auth_token:
-            console.print(
-                Panel(
-                    "[bold red]Error:[/bold red] XOA_URL and XOA_TOKEN must be provided either as command-line options or environment variables",
-                    title="Missing Credentials",
-                    border_style="red",
-                )
-            )
+        api = _get_api(xoa_url, xoa_token)
+        if api is None:
             return 1
 
-        api = XenOrchestraApi(host=xoa_host, auth_token=xoa_auth_token)
-
-        async with AsyncAPISession(api) as session_api:
+        # A failed handshake is reported once, by _print_error
+        async with AsyncAPISession(api, log_errors=False) as session_api:
             with console.status("[green]Fetching templates...[/green]"):
                 templates_dict = await session_api.list_templates()
 
@@ -276,22 +417,22 @@ async def _list_templates(xoa_url: str, xoa_token: str):
             table.add_column("CPUs", justify="right")
             table.add_column("Memory (GB)", justify="right")
 
-            for template_id, template_info in templates_dict.items():
-                memory_gb = round(
-                    template_info.get("memory", {}).get("size", 0) / (1024**3), 1
-                )
-                table.add_row(
+            rows = [
+                (
                     template_info.get("name_label", "Unknown"),
                     template_info.get("uuid", "Unknown"),
                     str(template_info.get("CPUs", {}).get("number", "N/A")),
-                    str(memory_gb),
+                    f"{template_info.get('memory', {}).get('size', 0) / GIB:.1f}",
                 )
+                for template_info in templates_dict.values()
+            ]
+            for row in rows:
+                table.add_row(*row)
 
             console.print(table)
 
     except Exception as e:
-        console.print(f"[bold red]Error:[/bold red] {str(e)}")
-        console.print_exception()
+        _print_error(e)
         return 1
 
     return 0
@@ -299,6 +440,14 @@ async def _list_templates(xoa_url: str, xoa_token: str):
 
 def main():
     """Entry point for the CLI."""
+    # uvloop is optional, it is only a faster event loop than asyncio's
+    try:
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     return cli()
 
 
@@ -1,8 +1,13 @@
-from .base import BaseImageProvider
+from types import MappingProxyType
+
+from .base import BaseImageProvider, prune_image_cache
 from .debian import DebianImageProvider
 from .ubuntu import UbuntuImageProvider
 
-IMAGE_PROVIDERS: dict[str, BaseImageProvider] = {
-    "debian": DebianImageProvider,
-    "ubuntu": UbuntuImageProvider,
-}
+# Provider classes by distribution name, read-only
+IMAGE_PROVIDERS: MappingProxyType[str, type[BaseImageProvider]] = MappingProxyType(
+    {
+        "debian": DebianImageProvider,
+        "ubuntu": UbuntuImageProvider,
+    }
+)
@@ -1,27 +1,565 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import shutil
 from abc import ABC
 from pathlib import Path
-from typing import Callable, Optional
+from typing import Any, AsyncIterator, BinaryIO, Callable, Optional
+
+import aiohttp
 
 IMAGE_OUTPUT_DIR = Path(__file__).parent / "images"
 
+# Size of the chunks streamed from the network to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Images take longer than aiohttp's default 5 minute total timeout to
+# download, so only bound the wait for each read
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_read=60)
+
+# Images are already compressed, so ask for them as is: compressing them again
+# on the way only costs CPU and makes Content-Length disagree with the body
+DOWNLOAD_HEADERS = {"Accept-Encoding": "identity"}
+
+# Mirrors occasionally answer with a transient gateway error or drop the
+# connection, so such requests are retried with an exponential backoff
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_RETRY_BACKOFF = 0.3
+DOWNLOAD_RETRY_STATUSES = frozenset({502, 503, 504})
+
+# A single TCP flow rarely fills the link, so large images are split in byte
+# ranges downloaded over several connections when the mirror supports it
+DOWNLOAD_RANGE_CONNECTIONS = 4
+DOWNLOAD_RANGE_MIN_SIZE = 256 * 1024 * 1024
+
+# Images used to be stored directly in IMAGE_OUTPUT_DIR, before they were
+# cached by upstream checksum, and are never read from there again
+LEGACY_IMAGE_SUFFIXES = frozenset({".qcow2", ".raw", ".iso"})
+
+# One lock per image digest so concurrent templates sharing the same source
+# image wait for a single download instead of fetching it several times
+IMAGE_LOCKS: dict[str, asyncio.Lock] = {}
+
+# Checksums files already fetched, by URL, so templates sharing a release
+# fetch its checksums file once
+CHECKSUMS_CACHE: dict[str, dict[str, str]] = {}
+CHECKSUMS_LOCKS: dict[str, asyncio.Lock] = {}
+
+
+class RangeNotHonouredError(ValueError):
+    """Raised when a server answers a range request without a partial content."""
+
+
+def get_image_lock(image_digest: str) -> asyncio.Lock:
+    """
+    Get the lock guarding the cache entry of an image.
+
+    Args:
+        image_digest: Upstream checksum of the image.
+
+    Returns:
+        Lock shared by every caller using the same image.
+    """
+    return IMAGE_LOCKS.setdefault(image_digest, asyncio.Lock())
+
+
+def drop_page_cache(path: Path) -> None:
+    """
+    Tell the kernel the cached pages of a file will not be read again soon.
+
+    Only a hint: nothing is done on platforms without posix_fadvise.
+
+    Args:
+        path: File whose pages can be evicted from the page cache.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def get_partial_path(image_path: Path) -> Path:
+    """
+    Get the path an image is written to until it is complete.
+
+    Images are only moved in place once complete and verified, so an
+    interrupted run never leaves a truncated image that later runs would
+    take as cached.
+
+    Args:
+        image_path: Path of the image once complete.
+
+    Returns:
+        Path next to the image, with a .part suffix.
+    """
+    return image_path.with_name(image_path.name + ".part")
+
+
+def preallocate(file: BinaryIO, size: int) -> None:
+    """
+    Reserve the disk space of a file about to be written.
+
+    Allocating the expected size at once avoids growing the file block by
+    block while it is downloaded. Filesystems not supporting it are ignored.
+
+    Args:
+        file: File opened for writing.
+        size: Expected size of the file in bytes, nothing is done if unknown.
+    """
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except OSError:
+        pass
+
+
+def _disk_usage(image_dir: Path) -> int:
+    """
+    Get the disk space used by the files of an image directory.
+
+    RAW images are sparse, so allocated blocks are counted where available.
+    """
+    usage = 0
+    for file_path in image_dir.iterdir():
+        stat = file_path.stat()
+        usage += stat.st_blocks * 512 if hasattr(stat, "st_blocks") else stat.st_size
+    return usage
+
+
+def prune_image_cache(max_size: Optional[int] = None) -> list[Path]:
+    """
+    Remove the least recently used images until the cache fits in max_size.
+
+    Images used during this run are marked as recently used and never removed.
+    Images left by the former layout, outside of the checksum directories,
+    are always removed.
+
+    Args:
+        max_size: Maximum size of the cache in bytes. By default the cache may
+            use half of the disk space available to it.
+
+    Returns:
+        Image directories and former layout images removed.
+    """
+    if not IMAGE_OUTPUT_DIR.is_dir():
+        return []
+
+    entries = []
+    removed = []
+    for image_dir in IMAGE_OUTPUT_DIR.iterdir():
+        if not image_dir.is_dir():
+            if image_dir.suffix in LEGACY_IMAGE_SUFFIXES:
+                image_dir.unlink(missing_ok=True)
+                removed.append(image_dir)
+            continue
+        # Every image used by this run took its lock
+        if image_dir.name in IMAGE_LOCKS:
+            os.utime(image_dir)
+        entries.append((image_dir.stat().st_mtime, _disk_usage(image_dir), image_dir))
+
+    cache_size = sum(size for _, size, _ in entries)
+    if max_size is None:
+        max_size = (shutil.disk_usage(IMAGE_OUTPUT_DIR).free + cache_size) // 2
+
+    for _, size, image_dir in sorted(entries):
+        if cache_size <= max_size:
+            break
+        if image_dir.name in IMAGE_LOCKS:
+            continue
+        shutil.rmtree(image_dir, ignore_errors=True)
+        cache_size -= size
+        removed.append(image_dir)
+    return removed
+
+
+@contextlib.asynccontextmanager
+async def http_session(
+    session: Optional[aiohttp.ClientSession] = None,
+) -> AsyncIterator[aiohttp.ClientSession]:
+    """
+    Use the given HTTP session, or a temporary one closed on exit.
+
+    Args:
+        session: Session shared by the caller, if any.
+
+    Yields:
+        Session to send the requests with.
+    """
+    if session is not None:
+        yield session
+        return
+
+    async with aiohttp.ClientSession() as temporary_session:
+        yield temporary_session
+
+
+@contextlib.asynccontextmanager
+async def open_download(
+    session: aiohttp.ClientSession, url: str, headers: Optional[dict] = None
+) -> AsyncIterator[aiohttp.ClientResponse]:
+    """
+    Send a GET request for a download, retrying transient failures.
+
+    Args:
+        session: Session to send the request with.
+        url: URL to download.
+        headers: Optional headers to send on top of DOWNLOAD_HEADERS.
+
+    Yields:
+        Successful response, with its body not read yet.
+    """
+    headers = {**DOWNLOAD_HEADERS, **(headers or {})}
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        last_attempt = attempt == DOWNLOAD_RETRIES
+        try:
+            response = await session.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+        except aiohttp.ClientConnectionError:
+            if last_attempt:
+                raise
+        else:
+            if response.status not in DOWNLOAD_RETRY_STATUSES or last_attempt:
+                break
+            response.release()
+        await asyncio.sleep(DOWNLOAD_RETRY_BACKOFF * 2**attempt)
+
+    try:
+        response.raise_for_status()
+        yield response
+    finally:
+        response.release()
+
+
+async def write_response(
+    response: aiohttp.ClientResponse,
+    file: BinaryIO,
+    file_hash: Any,
+    progress_callback: Callable[[float], None],
+    resumed_size: int = 0,
+) -> None:
+    """
+    Write a response body to a file, hashing it on the way.
+
+    Each chunk is written and hashed in a thread while the next one is
+    received, so disk latency and hashing neither stall the download nor
+    block the event loop.
+
+    Args:
+        response: Response whose body has not been read yet.
+        file: File opened for writing.
+        file_hash: Hash object updated with the body.
+        progress_callback: Callback function to report progress (0.0 to 1.0).
+        resumed_size: Size already downloaded when resuming a download.
+    """
+
+    def store(data: bytes) -> None:
+        file.write(data)
+        file_hash.update(data)
+
+    total_size = resumed_size + (response.content_length or 0)
+    downloaded_size = resumed_size
+    pending_store: Optional[asyncio.Future] = None
+    try:
+        async for data in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            # Chunks are stored in order, one at a time
+            if pending_store is not None:
+                await asyncio.shield(pending_store)
+            pending_store = asyncio.ensure_future(asyncio.to_thread(store, data))
+            downloaded_size += len(data)
+            if total_size:
+                progress_callback(downloaded_size / total_size)
+    finally:
+        # The caller closes the file, let the last chunk land first
+        if pending_store is not None:
+            await asyncio.wait([pending_store])
+    if pending_store is not None:
+        pending_store.result()
+
+
+def supports_range_download(response: aiohttp.ClientResponse) -> bool:
+    """
+    Check whether a download is worth splitting in byte ranges.
+
+    Args:
+        response: Response to a full GET request of the file.
+
+    Returns:
+        True if the server accepts range requests and the file is large enough.
+    """
+    return (
+        response.headers.get("Accept-Ranges", "").lower() == "bytes"
+        and (response.content_length or 0) >= DOWNLOAD_RANGE_MIN_SIZE
+    )
+
+
+def split_in_ranges(total_size: int) -> list[list[int]]:
+    """
+    Split a download in one byte range per connection.
+
+    Args:
+        total_size: Size of the file in bytes.
+
+    Returns:
+        [start, end) pairs covering the file, in order.
+    """
+    range_size = -(-total_size // DOWNLOAD_RANGE_CONNECTIONS)
+    return [
+        [start, min(start + range_size, total_size)]
+        for start in range(0, total_size, range_size)
+    ]
+
+
+def load_ranges(ranges_path: Path) -> Optional[list[list[int]]]:
+    """
+    Load the byte ranges left to download by an interrupted download.
+
+    Args:
+        ranges_path: File the ranges were saved to with save_ranges.
+
+    Returns:
+        [start, end) pairs, or None if there are no usable saved ranges.
+    """
+    try:
+        ranges = json.loads(ranges_path.read_bytes())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(ranges, list) or not all(
+        isinstance(byte_range, list)
+        and len(byte_range) == 2
+        and all(isinstance(bound, int) for bound in byte_range)
+        for byte_range in ranges
+    ):
+        return None
+    return ranges
+
+
+def save_ranges(ranges_path: Path, ranges: list[list[int]]) -> None:
+    """
+    Save the byte ranges left to download, so an interrupted download resumes.
+
+    Args:
+        ranges_path: File to save the ranges to, replaced atomically.
+        ranges: [start, end) pairs, as updated by download_ranges.
+    """
+    tmp_path = ranges_path.with_name(ranges_path.name + ".tmp")
+    tmp_path.write_text(json.dumps(ranges))
+    os.replace(tmp_path, ranges_path)
+
+
+async def download_ranges(
+    session: aiohttp.ClientSession,
+    url: str,
+    file: BinaryIO,
+    ranges: list[list[int]],
+    progress_callback: Callable[[float], None],
+) -> None:
+    """
+    Download a file over several connections, one byte range each.
+
+    Every range is written at its offset in the file, so the file does not
+    need to be written in order. As in write_response, each chunk is written
+    in a thread while the next one of its range is received.
+
+    The start of each range is moved forward as its chunks are written, so
+    once this returns or raises, ranges tells what is left to download.
+
+    Args:
+        session: Session to send the requests with.
+        url: URL to download.
+        file: File opened for writing.
+        ranges: [start, end) pairs, e.g. from split_in_ranges, updated in place.
+        progress_callback: Callback function to report progress (0.0 to 1.0).
+    """
+    fd = file.fileno()
+    total_size = ranges[-1][1]
+    downloaded_size = total_size - sum(end - start for start, end in ranges)
+
+    def write(byte_range: list[int], data: bytes) -> None:
+        os.pwrite(fd, data, byte_range[0])
+        byte_range[0] += len(data)
+
+    async def download_range(byte_range: list[int]) -> None:
+        nonlocal downloaded_size
+        start, end = byte_range
+        range_header = {"Range": f"bytes={start}-{end - 1}"}
+        async with open_download(session, url, range_header) as response:
+            if response.status != 206:
+                raise RangeNotHonouredError(f"Range request not honoured for {url}")
+            pending_write: Optional[asyncio.Future] = None
+            try:
+                async for data in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    # One write in flight per range
+                    if pending_write is not None:
+                        await asyncio.shield(pending_write)
+                    pending_write = asyncio.ensure_future(
+                        asyncio.to_thread(write, byte_range, data)
+                    )
+                    downloaded_size += len(data)
+                    progress_callback(downloaded_size / total_size)
+            finally:
+                # The caller closes the file, let the last chunk land first
+                if pending_write is not None:
+                    await asyncio.wait([pending_write])
+            if pending_write is not None:
+                pending_write.result()
+        if byte_range[0] != end:
+            raise ValueError(f"Incomplete range {start}-{end - 1} for {url}")
+
+    tasks = [
+        asyncio.ensure_future(download_range(byte_range))
+        for byte_range in ranges
+        if byte_range[0] < byte_range[1]
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other ranges before the caller closes the file
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def update_hash(file_hash: Any, file: BinaryIO, size: int) -> None:
+    """
+    Update a hash object with the next bytes of a file.
+
+    Args:
+        file_hash: Hash object to update.
+        file: File opened for reading, read from its current position.
+        size: Number of bytes to read.
+    """
+    while size > 0 and (data := file.read(min(size, DOWNLOAD_CHUNK_SIZE))):
+        file_hash.update(data)
+        size -= len(data)
+
+
+def hash_file(file_path: Path, algorithm: str) -> str:
+    """
+    Compute the hex digest of a file.
+
+    Args:
+        file_path: Path to the file.
+        algorithm: Name of the hashlib algorithm, e.g. "sha256".
+
+    Returns:
+        Hex digest of the file content.
+    """
+    file_hash = hashlib.new(algorithm)
+    with file_path.open("rb") as file:
+        while data := file.read(DOWNLOAD_CHUNK_SIZE):
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+
+async def fetch_checksums(
+    checksums_url: str, session: Optional[aiohttp.ClientSession] = None
+) -> dict[str, str]:
+    """
+    Fetch a checksums file (SHA256SUMS, SHA512SUMS, ...) published upstream.
+
+    Concurrent and later callers asking for the same URL share one request.
+
+    Args:
+        checksums_url: URL of the checksums file.
+        session: Optional HTTP session to reuse.
+
+    Returns:
+        Mapping of file names to their hex digest.
+    """
+    async with CHECKSUMS_LOCKS.setdefault(checksums_url, asyncio.Lock()):
+        if checksums_url not in CHECKSUMS_CACHE:
+            CHECKSUMS_CACHE[checksums_url] = await _download_checksums(
+                checksums_url, session
+            )
+        return CHECKSUMS_CACHE[checksums_url]
+
+
+async def _download_checksums(
+    checksums_url: str, session: Optional[aiohttp.ClientSession] = None
+) -> dict[str, str]:
+    """
+    Download and parse a checksums file.
+
+    Args:
+        checksums_url: URL of the checksums file.
+        session: Optional HTTP session to reuse.
+
+    Returns:
+        Mapping of file names to their hex digest.
+    """
+    async with http_session(session) as session:
+        async with open_download(session, checksums_url) as response:
+            content = await response.text()
+
+    checksums = {}
+    for line in content.splitlines():
+        parts = line.split()
+        if len(parts) != 2:
+            continue
+        digest, file_name = parts
+        # Binary mode entries are prefixed with '*'
+        checksums[file_name.lstrip("*")] = digest.lower()
+    return checksums
+
 
 class BaseImageProvider(ABC):
     """
     Base class for image providers.
     """
 
-    def __init__(
-        self,
-        version: str,
-        arch: str = "amd64",
-    ):
-        self.version = version
-        self.arch = arch
+    # Validated image config, set by the subclasses
+    config: Any
+    # Image file name and URL of the upstream directory publishing it, set by
+    # the subclasses
+    image_name: str
+    base_url: str
+    # Checksums file published upstream next to the images
+    CHECKSUMS_FILE: str
+
+    @property
+    def version(self) -> str:
+        return self.config.version
+
+    @property
+    def arch(self) -> str:
+        return self.config.arch
+
+    def get_image_url(self) -> str:
+        return f"{self.base_url}/{self.image_name}"
+
+    async def get_image_digest(
+        self, session: Optional[aiohttp.ClientSession] = None
+    ) -> str:
+        """
+        Get the upstream checksum of the image.
+
+        Images are cached by this checksum, so a new upstream build is never
+        mistaken for the cached one.
+
+        Args:
+            session: Optional HTTP session to reuse.
+
+        Returns:
+            Hex digest published for the image in CHECKSUMS_FILE.
+        """
+        checksums = await fetch_checksums(
+            f"{self.base_url}/{self.CHECKSUMS_FILE}", session
+        )
+        if self.image_name not in checksums:
+            raise ValueError(f"No checksum published for image {self.image_name}")
+        return checksums[self.image_name]
 
-    def download_image(
+    async def download_image(
         self,
         use_cache: bool = True,
         progress_callback: Optional[Callable[[float], None]] = None,
+        session: Optional[aiohttp.ClientSession] = None,
     ) -> Path:
         """
         Download the image with progress reporting.
@@ -29,6 +567,7 @@ class BaseImageProvider(ABC):
         Args:
             use_cache: If True, use cached image if available.
             progress_callback: Optional callback function to report progress (0.0 to 1.0).
+            session: Optional HTTP session to reuse, a temporary one is used otherwise.
 
         Returns:
             Path to the downloaded image in ISO format.
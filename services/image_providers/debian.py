@@ -1,16 +1,31 @@
 from enum import Enum
 from typing import Literal, Optional, Callable
 from pathlib import Path
+import hashlib
+import os
 from pydantic import BaseModel, field_validator
-import requests
-import subprocess
+import aiohttp
+import asyncio
 
 from ..tools import logger
 
-from .base import BaseImageProvider, IMAGE_OUTPUT_DIR
+from .base import (
+    BaseImageProvider,
+    IMAGE_OUTPUT_DIR,
+    drop_page_cache,
+    get_image_lock,
+    get_partial_path,
+    http_session,
+    open_download,
+    preallocate,
+    write_response,
+)
 
 DEBIAN_CLOUD_IMAGE_URL = "https://cdimage.debian.org/images/cloud"
 
+# Number of parallel coroutines used by qemu-img to convert an image
+QEMU_IMG_COROUTINES = 8
+
 
 class DebianVersion(str, Enum):
     BOOKWORM = "12"
@@ -65,36 +80,35 @@ class DebianImageProvider(BaseImageProvider):
     Debian image provider.
     """
 
+    CHECKSUMS_FILE = "SHA512SUMS"
+
     def __init__(
         self, version: str, arch: str = "amd64", variant: str = "genericcloud"
     ):
-        super().__init__(version, arch)
         # Validate the config with Pydantic
         self.config = DebianImageConfig(version=version, arch=arch, variant=variant)
 
-    def __get_version_name(self) -> str:
-        return VERSION_TO_NAME[self.config.version].value
-
-    def __get_image_name(self) -> str:
-        return f"debian-{self.config.version}-{self.config.variant}-{self.config.arch}.qcow2"
+        # The image location only depends on the config, build it once
+        version_name = VERSION_TO_NAME[self.config.version].value
+        self.image_name = f"debian-{self.config.version}-{self.config.variant}-{self.config.arch}.qcow2"
+        self.base_url = f"{DEBIAN_CLOUD_IMAGE_URL}/{version_name}/latest"
 
-    def __get_image_url(self) -> str:
-        version_name = self.__get_version_name()
-        image_name = self.__get_image_name()
-        return f"{DEBIAN_CLOUD_IMAGE_URL}/{version_name}/latest/{image_name}"
-
-    def __download(
+    async def __download(
         self,
         image_output_path: Path,
+        image_digest: str,
         use_cache: bool = True,
         progress_callback: Optional[Callable[[float], None]] = None,
+        session: Optional[aiohttp.ClientSession] = None,
     ) -> Path:
         """
         Download the image in qcow2 format.
         Args:
             image_output_path: Path to save the downloaded image.
+            image_digest: Expected SHA512 checksum of the image.
             use_cache: If True, use cached image if available.
             progress_callback: Optional callback function to report progress (0.0 to 1.0).
+            session: Optional HTTP session to reuse.
         """
         # Default no-op progress callback
         if progress_callback is None:
@@ -103,34 +117,45 @@ class DebianImageProvider(BaseImageProvider):
         progress_callback(0.0)
 
         # Check if the image already exists
-        if use_cache and image_output_path.exists():
-            logger.info(f"Image already exists: {image_output_path}")
+        if use_cache and await asyncio.to_thread(image_output_path.exists):
+            logger.info("Image already exists: %s", image_output_path)
             # Report 100% progress
             progress_callback(1.0)
             # Return the existing image path
             return image_output_path
 
         # Download the image
-        image_url = self.__get_image_url()
-        logger.info(f"Downloading image from {image_url} to {image_output_path}")
-        response = requests.get(image_url, stream=True)
-        response.raise_for_status()
-
-        total_size = int(response.headers.get("content-length", 0))
-        downloaded_size = 0
-        with image_output_path.open("wb+") as file:
-            for data in response.iter_content(chunk_size=8192):
-                file.write(data)
-                downloaded_size += len(data)
-                # Report progress
-                progress_callback(downloaded_size / total_size)
-        logger.info(f"Downloaded image to {image_output_path}")
+        image_url = self.get_image_url()
+        logger.info("Downloading image from %s to %s", image_url, image_output_path)
+        async with http_session(session) as session:
+            async with open_download(session, image_url) as response:
+                total_size = int(response.headers.get("content-length", 0))
+                image_hash = hashlib.sha512()
+                image_output_path.parent.mkdir(parents=True, exist_ok=True)
+                partial_path = get_partial_path(image_output_path)
+                try:
+                    with partial_path.open("wb+") as file:
+                        await asyncio.to_thread(preallocate, file, total_size)
+                        await write_response(
+                            response, file, image_hash, progress_callback
+                        )
+
+                    if image_hash.hexdigest() != image_digest:
+                        raise ValueError(
+                            f"Checksum mismatch for downloaded image {image_output_path.name}"
+                        )
+                except BaseException:
+                    partial_path.unlink(missing_ok=True)
+                    raise
+
+        os.replace(partial_path, image_output_path)
+        logger.info("Downloaded image to %s", image_output_path)
         # Report 100% progress
         progress_callback(1.0)
 
         return image_output_path
 
-    def __convert_image(
+    async def __convert_image(
         self,
         image_qcow2_path: Path,
         use_cache: bool = True,
@@ -145,48 +170,87 @@ class DebianImageProvider(BaseImageProvider):
         """
         image_raw_path = image_qcow2_path.with_suffix(".raw")
 
-        logger.info(f"Converting image to RAW format: {image_raw_path}")
+        logger.info("Converting image to RAW format: %s", image_raw_path)
 
         # Check if the RAW image already exists
-        if use_cache and image_raw_path.exists():
-            logger.info(f"RAW image already exists: {image_raw_path}")
+        if use_cache and await asyncio.to_thread(image_raw_path.exists):
+            logger.info("RAW image already exists: %s", image_raw_path)
             return image_raw_path
 
+        partial_path = get_partial_path(image_raw_path)
+
         # Use qemu-img to convert the image
-        subprocess.run(
-            [
-                "qemu-img",
-                "convert",
-                "-f",
-                "qcow2",
-                "-O",
-                "raw",
-                str(image_qcow2_path),
-                str(image_raw_path),
-            ],
-            check=True,
+        process = await asyncio.create_subprocess_exec(
+            "qemu-img",
+            "convert",
+            # Convert with parallel coroutines and allow out-of-order writes
+            "-m",
+            str(QEMU_IMG_COROUTINES),
+            "-W",
+            "-f",
+            "qcow2",
+            "-O",
+            "raw",
+            str(image_qcow2_path),
+            str(partial_path),
+            stderr=asyncio.subprocess.PIPE,
         )
-        logger.info(f"Converted image to RAW format: {image_raw_path}")
+        try:
+            _, stderr = await process.communicate()
+            if process.returncode != 0:
+                raise RuntimeError(
+                    f"qemu-img failed to convert {image_qcow2_path} (exit code {process.returncode}): {stderr.decode().strip()}"
+                )
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            partial_path.unlink(missing_ok=True)
+            raise
+
+        os.replace(partial_path, image_raw_path)
+        logger.info("Converted image to RAW format: %s", image_raw_path)
+
+        # Only the RAW image is uploaded, keep the page cache for it rather
+        # than for the qcow2 image that was just read
+        await asyncio.to_thread(drop_page_cache, image_qcow2_path)
         return image_raw_path
 
-    def download_image(self, use_cache=True, progress_callback=None):
+    async def download_image(
+        self, use_cache=True, progress_callback=None, session=None
+    ):
         """
         Download the image with progress reporting.
         Args:
             use_cache: If True, use cached image if available.
             progress_callback: Optional callback function to report progress (0.0 to 1.0).
+            session: Optional HTTP session to reuse.
         Returns:
             Path to the downloaded image in RAW format.
         """
+        image_digest = await self.get_image_digest(session)
+
         # Define the output path for the qcow2 image
-        image_qcow2_path = IMAGE_OUTPUT_DIR / self.__get_image_name()
+        image_qcow2_path = IMAGE_OUTPUT_DIR / image_digest / self.image_name
+        image_raw_path = image_qcow2_path.with_suffix(".raw")
 
-        # Download the image
-        self.__download(image_qcow2_path, use_cache, progress_callback)
+        async with get_image_lock(image_digest):
+            # The converted image is all that is uploaded, so the qcow2 one
+            # is not needed again once it exists
+            if use_cache and await asyncio.to_thread(image_raw_path.exists):
+                logger.info("RAW image already exists: %s", image_raw_path)
+                if progress_callback is not None:
+                    progress_callback(1.0)
+                return image_raw_path
+
+            # Download the image
+            await self.__download(
+                image_qcow2_path, image_digest, use_cache, progress_callback, session
+            )
 
-        # Convert to RAW format
-        image_raw_path = self.__convert_image(
-            image_qcow2_path, use_cache, progress_callback
-        )
+            # Convert to RAW format
+            image_raw_path = await self.__convert_image(
+                image_qcow2_path, use_cache, progress_callback
+            )
 
         return image_raw_path
@@ -1,11 +1,31 @@
 from typing import Literal, Optional, Callable
 from pathlib import Path
+import hashlib
+import os
 from pydantic import BaseModel
-import requests
+import aiohttp
+import asyncio
 
 from ..tools import logger
 
-from .base import BaseImageProvider, IMAGE_OUTPUT_DIR
+from .base import (
+    BaseImageProvider,
+    IMAGE_OUTPUT_DIR,
+    RangeNotHonouredError,
+    download_ranges,
+    get_image_lock,
+    get_partial_path,
+    hash_file,
+    http_session,
+    load_ranges,
+    open_download,
+    preallocate,
+    save_ranges,
+    split_in_ranges,
+    supports_range_download,
+    update_hash,
+    write_response,
+)
 
 UBUNTU_IMAGE_URL = "https://releases.ubuntu.com"
 
@@ -21,32 +41,34 @@ class UbuntuImageProvider(BaseImageProvider):
     Ubuntu image provider.
     """
 
+    CHECKSUMS_FILE = "SHA256SUMS"
+
     def __init__(self, version: str, arch: str = "amd64", variant: str = "live-server"):
-        super().__init__(version, arch)
         # Validate the config with Pydantic
         self.config = UbuntuImageConfig(version=version, arch=arch, variant=variant)
 
-    def __get_image_name(self) -> str:
-        return (
+        # The image location only depends on the config, build it once
+        self.image_name = (
             f"ubuntu-{self.config.version}-{self.config.variant}-{self.config.arch}.iso"
         )
+        self.base_url = f"{UBUNTU_IMAGE_URL}/{self.config.version}"
 
-    def __get_image_url(self) -> str:
-        image_name = self.__get_image_name()
-        return f"{UBUNTU_IMAGE_URL}/{self.config.version}/{image_name}"
-
-    def __download(
+    async def __download(
         self,
         image_output_path: Path,
+        image_digest: str,
         use_cache: bool = True,
         progress_callback: Optional[Callable[[float], None]] = None,
+        session: Optional[aiohttp.ClientSession] = None,
     ) -> Path:
         """
         Download the image in ISO format.
         Args:
             image_output_path: Path to save the downloaded image.
+            image_digest: Expected SHA256 checksum of the image.
             use_cache: If True, use cached image if available.
             progress_callback: Optional callback function to report progress (0.0 to 1.0).
+            session: Optional HTTP session to reuse.
         """
         # Default no-op progress callback
         if progress_callback is None:
@@ -55,46 +77,252 @@ class UbuntuImageProvider(BaseImageProvider):
         progress_callback(0.0)
 
         # Check if the image already exists
-        if use_cache and image_output_path.exists():
-            logger.info(f"Image already exists: {image_output_path}")
+        if use_cache and await asyncio.to_thread(image_output_path.exists):
+            logger.info("Image already exists: %s", image_output_path)
             # Report 100% progress
             progress_callback(1.0)
             # Return the existing image path
             return image_output_path
 
         # Download the image
-        image_url = self.__get_image_url()
-        logger.info(f"Downloading image from {image_url} to {image_output_path}")
-        response = requests.get(image_url, stream=True)
-        response.raise_for_status()
-
-        total_size = int(response.headers.get("content-length", 0))
-        downloaded_size = 0
-        with image_output_path.open("wb+") as file:
-            for data in response.iter_content(chunk_size=8192):
-                file.write(data)
-                downloaded_size += len(data)
-                # Report progress
-                progress_callback(downloaded_size / total_size)
-        logger.info(f"Downloaded image to {image_output_path}")
+        image_url = self.get_image_url()
+        logger.info("Downloading image from %s to %s", image_url, image_output_path)
+        image_output_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = get_partial_path(image_output_path)
+        # Byte ranges still missing from a partial file downloaded over
+        # several connections, which is written out of order
+        ranges_path = partial_path.with_name(partial_path.name + ".ranges")
+        # An interrupted download keeps what it received, resume from there
+        try:
+            resume_from = (await asyncio.to_thread(partial_path.stat)).st_size
+        except FileNotFoundError:
+            resume_from = 0
+        ranges = await asyncio.to_thread(load_ranges, ranges_path)
+
+        async with http_session(session) as session:
+            try:
+                if ranges is not None and resume_from:
+                    logger.info("Resuming split download of %s", partial_path)
+                    await self.__fetch_ranges(
+                        session,
+                        image_url,
+                        partial_path,
+                        ranges_path,
+                        image_digest,
+                        ranges,
+                        progress_callback,
+                    )
+                else:
+                    # Ranges left without their partial file are stale
+                    await asyncio.to_thread(ranges_path.unlink, missing_ok=True)
+                    await self.__fetch(
+                        session,
+                        image_url,
+                        partial_path,
+                        ranges_path,
+                        image_digest,
+                        resume_from,
+                        progress_callback,
+                    )
+            except aiohttp.ClientResponseError as error:
+                # The partial image is not smaller than the image, so it
+                # cannot be resumed: download it again
+                if ranges is not None or not resume_from or error.status != 416:
+                    raise
+                partial_path.unlink(missing_ok=True)
+                await self.__fetch(
+                    session,
+                    image_url,
+                    partial_path,
+                    ranges_path,
+                    image_digest,
+                    0,
+                    progress_callback,
+                )
+
+        # Without its ranges, a complete partial file is at worst resumed
+        # with a range request answered by a 416 and downloaded again
+        ranges_path.unlink(missing_ok=True)
+        os.replace(partial_path, image_output_path)
+        logger.info("Downloaded image to %s", image_output_path)
         # Report 100% progress
         progress_callback(1.0)
 
         return image_output_path
 
-    def download_image(self, use_cache=True, progress_callback=None):
+    async def __fetch(
+        self,
+        session: aiohttp.ClientSession,
+        image_url: str,
+        partial_path: Path,
+        ranges_path: Path,
+        image_digest: str,
+        resume_from: int,
+        progress_callback: Callable[[float], None],
+        split: bool = True,
+    ) -> None:
+        """
+        Download the image to its partial file and verify it.
+        Args:
+            session: HTTP session to send the requests with.
+            image_url: URL of the image.
+            partial_path: Path to download the image to.
+            ranges_path: Path to save the missing byte ranges to, if the
+                image is downloaded over several connections.
+            image_digest: Expected SHA256 checksum of the image.
+            resume_from: Size of the partial file left by an interrupted
+                download, only the rest of the image is requested.
+            progress_callback: Callback function to report progress (0.0 to 1.0).
+            split: Download a new image over several connections when the
+                server advertises range support.
+        """
+        range_header = {"Range": f"bytes={resume_from}-"} if resume_from else None
+        async with open_download(session, image_url, range_header) as response:
+            # Servers ignoring the range send the whole image again
+            if response.status != 206:
+                resume_from = 0
+            else:
+                logger.info("Resuming download of %s at %s", partial_path, resume_from)
+            total_size = resume_from + (response.content_length or 0)
+            if split and not resume_from and supports_range_download(response):
+                # The ranges are requested on their own connections
+                response.close()
+                await self.__fetch_ranges(
+                    session,
+                    image_url,
+                    partial_path,
+                    ranges_path,
+                    image_digest,
+                    split_in_ranges(total_size),
+                    progress_callback,
+                )
+                return
+
+            image_hash = hashlib.sha256()
+            try:
+                with partial_path.open("r+b" if resume_from else "wb+") as file:
+                    # Hash what was already received, leaving the file
+                    # position at its end
+                    await asyncio.to_thread(update_hash, image_hash, file, resume_from)
+                    await asyncio.to_thread(preallocate, file, total_size)
+                    try:
+                        await write_response(
+                            response,
+                            file,
+                            image_hash,
+                            progress_callback,
+                            resume_from,
+                        )
+                    except BaseException:
+                        # Drop the preallocated space past what was
+                        # written, so the file size tells where to resume
+                        file.truncate(file.tell())
+                        raise
+
+                self.__verify(image_hash.hexdigest(), image_digest)
+            except ValueError:
+                # Only resume an image while it is not known to be wrong
+                partial_path.unlink(missing_ok=True)
+                raise
+
+    async def __fetch_ranges(
+        self,
+        session: aiohttp.ClientSession,
+        image_url: str,
+        partial_path: Path,
+        ranges_path: Path,
+        image_digest: str,
+        ranges: list[list[int]],
+        progress_callback: Callable[[float], None],
+    ) -> None:
+        """
+        Download the missing byte ranges of the image over several
+        connections and verify it.
+        Args:
+            session: HTTP session to send the requests with.
+            image_url: URL of the image.
+            partial_path: Path to download the image to.
+            ranges_path: Path to save the missing byte ranges to, so an
+                interrupted download resumes where each range stopped.
+            image_digest: Expected SHA256 checksum of the image.
+            ranges: [start, end) pairs still to download, all of the image
+                for a new download.
+            progress_callback: Callback function to report progress (0.0 to 1.0).
+        """
+        try:
+            with partial_path.open("r+b" if partial_path.exists() else "wb+") as file:
+                # Saved before anything is written, so a partial file is
+                # never taken for one downloaded in order
+                await asyncio.to_thread(save_ranges, ranges_path, ranges)
+                await asyncio.to_thread(preallocate, file, ranges[-1][1])
+                try:
+                    await download_ranges(
+                        session, image_url, file, ranges, progress_callback
+                    )
+                finally:
+                    # Small enough to write even while being cancelled
+                    save_ranges(ranges_path, ranges)
+
+            # Ranges arrive out of order, so hash the file once complete
+            downloaded_digest = await asyncio.to_thread(
+                hash_file, partial_path, "sha256"
+            )
+            self.__verify(downloaded_digest, image_digest)
+        except RangeNotHonouredError:
+            # Some servers advertise range support but answer range requests
+            # with the whole image, download it in one stream instead
+            logger.info("Range requests not honoured for %s", image_url)
+            partial_path.unlink(missing_ok=True)
+            ranges_path.unlink(missing_ok=True)
+            await self.__fetch(
+                session,
+                image_url,
+                partial_path,
+                ranges_path,
+                image_digest,
+                0,
+                progress_callback,
+                split=False,
+            )
+        except ValueError:
+            # Wrong data, start over
+            partial_path.unlink(missing_ok=True)
+            ranges_path.unlink(missing_ok=True)
+            raise
+
+    def __verify(self, downloaded_digest: str, image_digest: str) -> None:
+        """
+        Check a downloaded image against its upstream checksum.
+        Args:
+            downloaded_digest: SHA256 checksum of the downloaded image.
+            image_digest: Expected SHA256 checksum of the image.
+        """
+        if downloaded_digest != image_digest:
+            raise ValueError(
+                f"Checksum mismatch for downloaded image {self.image_name}"
+            )
+
+    async def download_image(
+        self, use_cache=True, progress_callback=None, session=None
+    ):
         """
         Download the image with progress reporting.
         Args:
             use_cache: If True, use cached image if available.
             progress_callback: Optional callback function to report progress (0.0 to 1.0).
+            session: Optional HTTP session to reuse.
         Returns:
             Path to the downloaded image in ISO format.
         """
-        # Define the output path for the qcow2 image
-        image_iso_path = IMAGE_OUTPUT_DIR / self.__get_image_name()
+        image_digest = await self.get_image_digest(session)
 
-        # Download the image
-        self.__download(image_iso_path, use_cache, progress_callback)
+        # Define the output path for the ISO image
+        image_iso_path = IMAGE_OUTPUT_DIR / image_digest / self.image_name
+
+        async with get_image_lock(image_digest):
+            # Download the image
+            await self.__download(
+                image_iso_path, image_digest, use_cache, progress_callback, session
+            )
 
         return image_iso_path
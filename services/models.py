@@ -5,7 +5,7 @@ from .image_providers import IMAGE_PROVIDERS
 
 
 class SourceConfig(BaseModel):
-    model_config = ConfigDict(coerce_numbers_to_str=True)
+    model_config = ConfigDict(coerce_numbers_to_str=True, frozen=True)
 
     distribution: str = Field(description="The Linux distribution")
     architecture: Literal["amd64", "arm64"] = Field(description="The CPU architecture")
@@ -26,6 +26,8 @@ class SourceConfig(BaseModel):
 
 
 class TargetConfig(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     name: str = Field(description="The name of the target template")
     cpu: int = Field(description="Number of CPUs", ge=1)
     memory: int = Field(description="Memory in GB", ge=1)
@@ -34,6 +36,8 @@ class TargetConfig(BaseModel):
 
 
 class TemplateConfig(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     source: SourceConfig = Field(description="Source image configuration")
     target: TargetConfig = Field(description="Target VM configuration")
 
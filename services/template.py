@@ -1,5 +1,8 @@
+import re
 import time
+import logging
 import asyncio
+import functools
 from pathlib import Path
 from rich.table import Table
 from typing import Optional, Callable
@@ -9,6 +12,17 @@ from .image_providers import IMAGE_PROVIDERS, BaseImageProvider
 from .xen_orchestra import XenOrchestraApi
 from .models import TemplateConfig
 
+# Last build ID handed out, so managers created together never share one
+_last_build_id = 0
+
+
+@functools.lru_cache(maxsize=None)
+def _build_id_pattern(template_base_name: str) -> re.Pattern:
+    """
+    Get the compiled pattern matching '<template base name>.<build ID>' labels.
+    """
+    return re.compile(rf"^{re.escape(template_base_name)}\.(\d+)$")
+
 
 class TemplateManager:
     def __init__(
@@ -57,78 +71,108 @@ class TemplateManager:
             self.task_id, description=f"{self.template_name} {description}"
         )
 
+    def __progress_callback(self, description: str) -> Callable[[float], None]:
+        """
+        Build a callback showing a step's progress as a percentage.
+
+        Transfers report progress for every chunk, so the description is only
+        updated when the displayed percentage changes.
+
+        Args:
+            description: Description of the step.
+
+        Returns:
+            Callback taking the progress, between 0 and 1.
+        """
+        last_percent = -1
+
+        def progress_callback(progress: float) -> None:
+            nonlocal last_percent
+            percent = int(progress * 100)
+            if percent != last_percent:
+                last_percent = percent
+                self.__set_description(f"{description} {percent}%")
+
+        return progress_callback
+
     async def generate(self, xo_api: XenOrchestraApi) -> None:
         logger.info(
-            f"[{self.template_name}] Step 1/7: Downloading and preparing image..."
+            "[%s] Step 1/7: Downloading and preparing image...", self.template_name
         )
+        logger.info("[%s] Step 2/7: Getting XCP-ng resources...", self.template_name)
         download_image_description = "⬇️ Downloading image"
         self.__set_description(download_image_description)
 
-        def dl_image_progress_callback(progress: float) -> None:
-            self.__set_description(
-                f"{download_image_description} {int(progress * 100)}%"
-            )
-
-        image_path = await self.__download(dl_image_progress_callback)
-        self.__advance_task()
-
-        logger.info(f"[{self.template_name}] Step 2/7: Getting XCP-ng resources...")
-        self.__set_description("🔍 Gathering resources")
-        # Gather resources in parallel
-        sr_id, template_id, network_id = await asyncio.gather(
-            self._get_storage_repository(xo_api),
-            self._get_base_template(xo_api),
-            self._get_network(xo_api),
+        # The resource lookups are independent from the image, so they run
+        # during the download instead of after it. Both are awaited even if
+        # one fails, so no download is left running in the background.
+        image_path, resources = await asyncio.gather(
+            self.__download(
+                xo_api, self.__progress_callback(download_image_description)
+            ),
+            self._get_resources(xo_api),
+            return_exceptions=True,
         )
+        for result in (image_path, resources):
+            if isinstance(result, BaseException):
+                raise result
+        sr_id, template_id, network_id = resources
+        self.__advance_task()
         self.__advance_task()
 
         # Step 3: Import disk
-        logger.info(f"[{self.template_name}] Step 3/7: Importing disk...")
+        logger.info("[%s] Step 3/7: Importing disk...", self.template_name)
         import_disk_description = "📤 Importing disk"
         self.__set_description(import_disk_description)
 
-        def disk_import_progress_callback(progress: float) -> None:
-            self.__set_description(f"{import_disk_description} {int(progress * 100)}%")
-
         vdi_id = await self._import_disk(
-            xo_api, image_path, sr_id, disk_import_progress_callback
+            xo_api, image_path, sr_id, self.__progress_callback(import_disk_description)
         )
         self.__advance_task()
 
         # Step 4: Create and configure VM
-        logger.info(f"[{self.template_name}] Step 4/7: Creating VM...")
+        logger.info("[%s] Step 4/7: Creating VM...", self.template_name)
         self.__set_description("🖥️ Creating VM")
         vm_id = await self._create_vm(xo_api, template_id, network_id)
         self.__advance_task()
 
         # Step 5: Attach disk and set boot order
-        logger.info(f"[{self.template_name}] Step 5/7: Configuring VM...")
+        logger.info("[%s] Step 5/7: Configuring VM...", self.template_name)
         self.__set_description("⚙️ Configuring VM")
         await self._configure_vm(xo_api, vm_id, vdi_id)
         self.__advance_task()
 
         # Step 6: Convert VM to template
-        logger.info(f"[{self.template_name}] Step 6/7: Converting to template...")
+        logger.info("[%s] Step 6/7: Converting to template...", self.template_name)
         self.__set_description("🛠️ Converting to template")
         await self._convert_to_template(xo_api, vm_id)
         self.__advance_task()
 
         # Step 7: Delete old templates
-        logger.info(f"[{self.template_name}] Step 7/7: Cleaning up old templates...")
+        logger.info("[%s] Step 7/7: Cleaning up old templates...", self.template_name)
         self.__set_description("🧹 Cleaning up old templates")
         await self._delete_old_templates(xo_api)
         self.__advance_task()
 
         self.__set_description("✅ Template created successfully")
         logger.info(
-            f"[{self.template_name}] Template '{self.template_name}' created successfully with ID: {vm_id}"
+            "[%s] Template '%s' created successfully with ID: %s",
+            self.template_name,
+            self.template_name,
+            vm_id,
         )
 
     def __generate_build_id(self) -> int:
         """
         Generate a unique build ID.
+
+        Nanosecond timestamps keep build IDs ordered with the older
+        second-based ones, and are bumped when the clock is too coarse to
+        tell two managers apart.
         """
-        return int(time.time())
+        global _last_build_id
+        _last_build_id = max(time.time_ns(), _last_build_id + 1)
+        return _last_build_id
 
     def __template_base_name(self) -> str:
         """
@@ -136,10 +180,12 @@ class TemplateManager:
         """
         return f"template.{self.template_config.target.name}"
 
-    @property
+    @functools.cached_property
     def template_name(self) -> str:
         """
         Generate a unique template name.
+
+        Cached since the build ID never changes and every log line uses it.
         """
         return f"{self.__template_base_name()}.{self.build_id}"
 
@@ -161,10 +207,12 @@ class TemplateManager:
         ]
 
     async def __download(
-        self, progress_callback: Optional[Callable[[float], None]] = None
+        self,
+        xo_api: XenOrchestraApi,
+        progress_callback: Optional[Callable[[float], None]] = None,
     ) -> Path:
         """
-        Download the image.
+        Download the image, reusing the HTTP connection pool of the API session.
         """
         image_provider = IMAGE_PROVIDERS[self.template_config.source.distribution]
 
@@ -174,60 +222,68 @@ class TemplateManager:
             variant=self.template_config.source.variant,
         )
 
-        image_path = image_provider_instance.download_image(
-            use_cache=True, progress_callback=progress_callback
+        image_path = await image_provider_instance.download_image(
+            use_cache=True, progress_callback=progress_callback, session=xo_api.session
         )
 
         return image_path
 
-    async def _get_storage_repository(self, xo_api: XenOrchestraApi) -> str:
-        """Get storage repository ID by name."""
+    async def _get_resources(self, xo_api: XenOrchestraApi) -> tuple[str, str, str]:
+        """Get storage repository, base template and network IDs by name."""
+        sr_name = self.template_config.target.sr
+        base_template_name = self.template_config.source.base_template
+        network_name = self.template_config.target.network
         logger.debug(
-            f"[{self.template_name}] Looking for storage repository: {self.template_config.target.sr}"
+            "[%s] Looking for storage repository: %s, base template: %s, network: %s",
+            self.template_name,
+            sr_name,
+            base_template_name,
+            network_name,
+        )
+
+        # Resolve the three resources in a single batch
+        sr_id, template_id, network_id = await xo_api.get_objects_by_name(
+            [
+                ("SR", sr_name),
+                ("VM-template", base_template_name),
+                ("network", network_name),
+            ]
         )
-        sr_id = await xo_api.get_sr_by_name(self.template_config.target.sr)
+
         if not sr_id:
             raise ValueError(
-                f"[{self.template_name}] Storage repository '{self.template_config.target.sr}' not found"
+                f"[{self.template_name}] Storage repository '{sr_name}' not found"
             )
         logger.info(
-            f"[{self.template_name}] Storage repository {self.template_config.target.sr} found with ID: {sr_id}"
+            "[%s] Storage repository %s found with ID: %s",
+            self.template_name,
+            sr_name,
+            sr_id,
         )
-        return sr_id
 
-    async def _get_base_template(self, xo_api: XenOrchestraApi) -> str:
-        """Get base template ID for the given distribution."""
-        logger.debug(
-            f"[{self.template_name}] Looking for base template: {self.template_config.source.base_template}"
-        )
-        template_id = await xo_api.get_template_by_name(
-            self.template_config.source.base_template
-        )
         if not template_id:
             raise ValueError(
-                f"[{self.template_name}] Template '{self.template_config.source.base_template}' not found"
+                f"[{self.template_name}] Template '{base_template_name}' not found"
             )
         logger.info(
-            f"[{self.template_name}] Base Template {self.template_config.source.base_template} found with ID: {template_id}"
+            "[%s] Base Template %s found with ID: %s",
+            self.template_name,
+            base_template_name,
+            template_id,
         )
-        return template_id
 
-    async def _get_network(self, xo_api: XenOrchestraApi) -> str:
-        """Get network ID by name."""
-        logger.debug(
-            f"[{self.template_name}] Looking for network: {self.template_config.target.network}"
-        )
-        network_id = await xo_api.get_network_by_name(
-            self.template_config.target.network
-        )
         if not network_id:
             raise ValueError(
-                f"[{self.template_name}] Network '{self.template_config.target.network}' not found"
+                f"[{self.template_name}] Network '{network_name}' not found"
             )
         logger.info(
-            f"[{self.template_name}] Network {self.template_config.target.network} found with ID: {network_id}"
+            "[%s] Network %s found with ID: %s",
+            self.template_name,
+            network_name,
+            network_id,
         )
-        return network_id
+
+        return sr_id, template_id, network_id
 
     async def _import_disk(
         self,
@@ -241,19 +297,24 @@ class TemplateManager:
         file_format = image_path.suffix[1:]
         upload_file_name = f"{image_path.stem}.{self.build_id}.{file_format}"
 
-        image_size = image_path.stat().st_size
+        # stat may block on network filesystems
+        image_size = (await asyncio.to_thread(image_path.stat)).st_size
 
         logger.info(
-            f"[{self.template_name}] Importing disk {upload_file_name} (size: {image_size}) to Xen Orchestra..."
+            "[%s] Importing disk %s (size: %s) to Xen Orchestra...",
+            self.template_name,
+            upload_file_name,
+            image_size,
         )
 
-        vdi_id = xo_api.import_disk(
+        vdi_id = await xo_api.import_disk(
             sr_id=sr_id,
             file_path=image_path,
             upload_name=upload_file_name,
             progress_callback=progress_callback,
+            file_size=image_size,
         )
-        logger.info(f"[{self.template_name}] Disk imported with ID: {vdi_id}")
+        logger.info("[%s] Disk imported with ID: %s", self.template_name, vdi_id)
         if not vdi_id:
             raise ValueError(
                 f"[{self.template_name}] Failed to import disk '{upload_file_name}'"
@@ -265,7 +326,7 @@ class TemplateManager:
         self, xo_api: XenOrchestraApi, template_id: str, network_id: str
     ) -> str:
         """Create a VM for the template."""
-        logger.debug(f"[{self.template_name}] Creating VM: {self.template_name}")
+        logger.debug("[%s] Creating VM: %s", self.template_name, self.template_name)
 
         vm_id = await xo_api.create_vm(
             name_label=self.template_name,
@@ -277,7 +338,10 @@ class TemplateManager:
             tags=self.__template_tags(),
         )
         logger.info(
-            f"[{self.template_name}] VM {self.template_name} created with ID: {vm_id}"
+            "[%s] VM %s created with ID: %s",
+            self.template_name,
+            self.template_name,
+            vm_id,
         )
         return vm_id
 
@@ -285,32 +349,43 @@ class TemplateManager:
         self, xo_api: XenOrchestraApi, vm_id: str, vdi_id: str
     ) -> bool:
         """Configure VM with disk and boot order."""
-        logger.debug(f"[{self.template_name}] Attaching VDI to VM...")
-        attach_result = await xo_api.attach_vdi_to_vm(
-            vm_id=vm_id,
-            vdi_id=vdi_id,
+        # The boot order is a VM parameter that does not depend on the disk
+        # being attached yet, so both calls share one round-trip
+        logger.debug(
+            "[%s] Attaching VDI to VM and setting boot order...", self.template_name
         )
-        logger.info(
-            f"[{self.template_name}] VDI {vdi_id} attached to VM {vm_id}: {attach_result}"
+        attach_result, boot_result = await asyncio.gather(
+            xo_api.attach_vdi_to_vm(
+                vm_id=vm_id,
+                vdi_id=vdi_id,
+            ),
+            xo_api.set_boot_order(
+                vm_id=vm_id,
+                boot_order="cd",
+            ),
         )
-
-        logger.debug(f"[{self.template_name}] Setting boot order...")
-        boot_result = await xo_api.set_boot_order(
-            vm_id=vm_id,
-            boot_order="cd",
+        logger.info(
+            "[%s] VDI %s attached to VM %s: %s",
+            self.template_name,
+            vdi_id,
+            vm_id,
+            attach_result,
         )
         logger.info(
-            f"[{self.template_name}] Boot order set for VM {vm_id}: {boot_result}"
+            "[%s] Boot order set for VM %s: %s", self.template_name, vm_id, boot_result
         )
 
         return attach_result and boot_result
 
     async def _convert_to_template(self, xo_api: XenOrchestraApi, vm_id: str) -> bool:
         """Convert VM to template."""
-        logger.debug(f"[{self.template_name}] Converting VM to template...")
+        logger.debug("[%s] Converting VM to template...", self.template_name)
         convert_result = await xo_api.convert_vm_to_template(vm_id=vm_id)
         logger.info(
-            f"[{self.template_name}] VM {vm_id} converted to template: {convert_result}"
+            "[%s] VM %s converted to template: %s",
+            self.template_name,
+            vm_id,
+            convert_result,
         )
 
         return convert_result
@@ -319,61 +394,65 @@ class TemplateManager:
         """Delete old templates with the same name but older build IDs."""
         template_base_name = self.__template_base_name()
         logger.debug(
-            f"[{self.template_name}] Looking for old templates with base name: {template_base_name}"
+            "[%s] Looking for old templates with base name: %s",
+            self.template_name,
+            template_base_name,
         )
 
-        all_templates = await xo_api.list_templates()
+        # Templates finishing together share the same listing
+        all_templates = await xo_api.list_templates_cached()
 
-        # Find templates with matching name pattern
-        matching_templates = []
+        # Find the older builds in a single pass, keeping the template just
+        # created, matched by name since IDs are UUIDs
+        build_id_pattern = _build_id_pattern(template_base_name)
+        template_ids: list[str] = []
+        template_labels: list[str] = []
         for template_id, template_info in all_templates.items():
             template_label = template_info.get("name_label", "")
-            if template_base_name in template_label:
-                # Extract build ID from template name
-                try:
-                    build_id = int(template_label.split(".")[-1])
-                    matching_templates.append(
-                        {
-                            "id": template_id,
-                            "name": template_label,
-                            "build_id": build_id,
-                        }
-                    )
-                except (ValueError, IndexError):
-                    # Skip if build ID extraction fails
-                    continue
-
-        # Sort templates by build ID (descending)
-        matching_templates.sort(key=lambda x: x["build_id"], reverse=True)
+            if template_label != self.template_name and build_id_pattern.match(
+                template_label
+            ):
+                template_ids.append(template_id)
+                template_labels.append(template_label)
 
         logger.debug(
-            f"[{self.template_name}] Found {len(matching_templates)} matching templates"
+            "[%s] Found %s old templates",
+            self.template_name,
+            len(template_ids),
         )
 
-        templates_to_delete = [
-            template
-            for template in matching_templates
-            if template["id"] != self.template_name
-        ]
-
-        if not templates_to_delete:
+        if not template_ids:
             logger.debug(
-                f"[{self.template_name}] No old templates to delete for '{template_base_name}'"
+                "[%s] No old templates to delete for '%s'",
+                self.template_name,
+                template_base_name,
             )
             return
 
-        # Delete old templates
-        for template in templates_to_delete:
-            try:
+        # Delete old templates in one batch, a failure must not stop the others
+        if logger.isEnabledFor(logging.DEBUG):
+            for template_id, template_label in zip(template_ids, template_labels):
                 logger.debug(
-                    f"Deleting old template: {template['name']} (ID: {template['id']})"
-                )
-                delete_result = await xo_api.delete_template(template["id"])
-                logger.info(
-                    f"[{self.template_name}] Template '{template['name']}' with ID {template['id']} deleted: {delete_result}"
+                    "Deleting old template: %s (ID: %s)", template_label, template_id
                 )
-            except Exception as e:
+        delete_results = await xo_api.delete_templates(template_ids)
+
+        for template_id, template_label, delete_result in zip(
+            template_ids, template_labels, delete_results
+        ):
+            if isinstance(delete_result, Exception):
                 logger.warning(
-                    f"[{self.template_name}] Failed to delete template '{template['name']} (ID: {template['id']})': {e}"
+                    "[%s] Failed to delete template '%s (ID: %s)': %s",
+                    self.template_name,
+                    template_label,
+                    template_id,
+                    delete_result,
                 )
                 continue
+            logger.info(
+                "[%s] Template '%s' with ID %s deleted: %s",
+                self.template_name,
+                template_label,
+                template_id,
+                delete_result,
+            )
@@ -1,3 +1,2 @@
 from .log import logger
 from .multi_task_progress import MultiTaskProgress
-from .buffered_reader import BufferedReaderWithProgressCallback
@@ -6,3 +6,6 @@ logger = logging.getLogger("xo_template_generator")
 logger.setLevel(logging.INFO)
 # Don't propagate to root logger to avoid duplicate messages
 logger.propagate = False
+# Stay silent until main.py adds its handler, instead of falling back to
+# logging's last resort handler
+logger.addHandler(logging.NullHandler())
@@ -35,33 +35,34 @@ class MultiTaskProgress:
         )
 
         self.tasks: list[TaskID] = []
+        # Running totals of all jobs, so a job update does not rescan them all
+        self.total = 0
+        self.completed = 0
 
     def add_task(self, description: str, total: Optional[int] = None) -> TaskID:
         task = self.job_progress.add_task(description, total=total)
-        self.refresh_overall_progress_bar()
+        self.total += total if total is not None else 1  # Assuming 1 without a total
+        self.__update_overall_progress_bar()
         self.tasks.append(task)
         return task
 
     def complete_task(self, task_id: TaskID):
-        self.job_progress.tasks[task_id].total = self.job_progress.tasks[
-            task_id
-        ].completed
-        self.refresh_overall_progress_bar()
+        task = self.job_progress.tasks[task_id]
+        self.total += task.completed - (task.total if task.total is not None else 1)
+        task.total = task.completed
+        self.__update_overall_progress_bar()
 
     def advance_task(self, task_id: TaskID, advance: int = 1):
         self.job_progress.advance(task_id, advance)
-        self.refresh_overall_progress_bar()
+        self.completed += advance
+        self.__update_overall_progress_bar()
 
     def set_description(self, task_id: TaskID, description: str):
-        self.job_progress.tasks[task_id].description = description
-        self.refresh_overall_progress_bar()
+        # The description does not change the overall progress
+        self.job_progress.update(task_id, description=description)
 
     def refresh_overall_progress_bar(self):
-        if not self.job_progress.tasks:
-            self.overall_progress.update(self.overall_task, completed=0, total=0)
-            return
-
-        total = sum(
+        self.total = sum(
             (
                 task.total
                 if task.total is not None
@@ -69,9 +70,12 @@ class MultiTaskProgress:
             )
             for task in self.job_progress.tasks
         )
-        completed = sum(task.completed for task in self.job_progress.tasks)
+        self.completed = sum(task.completed for task in self.job_progress.tasks)
+        self.__update_overall_progress_bar()
+
+    def __update_overall_progress_bar(self):
         self.overall_progress.update(
-            self.overall_task, completed=completed, total=total
+            self.overall_task, completed=self.completed, total=self.total
         )
 
     def render(self) -> Table.grid:
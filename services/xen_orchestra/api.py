@@ -1,14 +1,58 @@
+import asyncio
+import functools
+import os
+import time
 from pathlib import Path
-from typing import Optional, Callable
+from types import MappingProxyType
+from urllib.parse import quote
+from typing import Any, AsyncIterator, Awaitable, Optional, Callable, Sequence
 
+import aiofiles
 import aiohttp
-import requests
 from jsonrpc_websocket import Server
 
-from ..tools import BufferedReaderWithProgressCallback
-
 from .models import VmCreateParams, DiskAttachParams, BootOrderParams
 
+# orjson is optional, it is only faster than the standard library
+try:
+    import orjson
+
+    def _dumps_sorted(value: Any) -> bytes:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+
+except ImportError:
+    import json
+
+    def _dumps_sorted(value: Any) -> bytes:
+        return json.dumps(value, sort_keys=True).encode()
+
+
+# Size of the chunks read from disk and streamed to Xen Orchestra
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Time to wait for Xen Orchestra to answer once the disk is uploaded
+UPLOAD_SOCK_READ_TIMEOUT = 600
+# Maximum age in seconds of a cached template listing
+TEMPLATES_CACHE_TTL = 30
+# vm.create parameters that are the same for every template VM
+VM_CREATE_DEFAULTS = MappingProxyType(
+    {
+        "acls": (),
+        "clone": False,
+        "existingDisks": {},
+        "installation": {"method": "network", "repository": "pxe"},
+        "VDIs": (),
+        "cpuWeight": None,
+        "cpuCap": None,
+        "copyHostBiosStrings": True,
+        "createVtpm": False,
+        "destroyCloudConfigVdiAfterBoot": False,
+        "secureBoot": False,
+        "shared": False,
+        "coreOs": False,
+        "hvmBootFirmware": "uefi",
+    }
+)
+
 
 class XenOrchestraApi:
     def __init__(self, host: str, auth_token: str) -> None:
@@ -19,9 +63,19 @@ class XenOrchestraApi:
         self.http_cookies = {
             "authenticationToken": auth_token,
         }
+        # Disk upload URL, only the SR and the disk name change
+        self._vdi_upload_url = (
+            self.http_host + "/rest/v0/srs/{sr_id}/vdis?raw&name_label={name}"
+        )
 
-    async def connect(self):
-        self.session = aiohttp.ClientSession()
+        self._templates_cache: Optional[tuple[float, dict]] = None
+        self._templates_lock = asyncio.Lock()
+        self._calls_cache: dict[tuple[str, bytes], asyncio.Future] = {}
+
+    async def connect(self, session: Optional[aiohttp.ClientSession] = None):
+        # Only close the HTTP session on disconnect if it was created here
+        self._owns_session = session is None
+        self.session = session or aiohttp.ClientSession()
         self.ws = Server(self.host, session=self.session)
         await self.ws.ws_connect()
 
@@ -30,7 +84,73 @@ class XenOrchestraApi:
 
     async def disconnect(self) -> None:
         await self.ws.close()
-        await self.session.close()
+        if self._owns_session:
+            await self.session.close()
+
+    def __call(self, method: str, params: dict, use_cache: bool) -> Awaitable:
+        rpc_method = functools.reduce(getattr, method.split("."), self.ws)
+        if not use_cache:
+            return rpc_method(**params)
+
+        cache_key = (method, _dumps_sorted(params))
+        if cache_key not in self._calls_cache:
+            call = asyncio.ensure_future(rpc_method(**params))
+            # Only keep successful results so a failed call can be retried
+            call.add_done_callback(
+                lambda done: (done.cancelled() or done.exception())
+                and self._calls_cache.pop(cache_key, None)
+            )
+            self._calls_cache[cache_key] = call
+        return self._calls_cache[cache_key]
+
+    async def call_batch(
+        self,
+        calls: list[tuple[str, dict]],
+        use_cache: bool = False,
+        return_exceptions: bool = False,
+    ) -> list[Any]:
+        """Send several JSON-RPC calls at once.
+
+        Every request is written to the websocket before any response is
+        awaited, so the whole batch costs a single round-trip.
+
+        Args:
+            calls: (method, params) pairs, e.g. ("xo.getAllObjects", {"filter": {...}})
+            use_cache: Reuse the result of identical calls made earlier on this
+                session, only suitable for read-only methods
+            return_exceptions: Return the exception raised by a failed call in
+                place of its result instead of raising it
+
+        Returns:
+            list: The result of each call, in the same order as calls
+        """
+        return await asyncio.gather(
+            *(self.__call(method, params, use_cache) for method, params in calls),
+            return_exceptions=return_exceptions,
+        )
+
+    async def get_objects_by_name(
+        self, lookups: list[tuple[str, str]]
+    ) -> list[Optional[str]]:
+        """Resolve several objects by type and name in a single batch.
+
+        Args:
+            lookups: (type, name_label) pairs, e.g. ("SR", "Local storage")
+
+        Returns:
+            list: The ID of each object, or None when it does not exist
+        """
+        results = await self.call_batch(
+            [
+                (
+                    "xo.getAllObjects",
+                    {"filter": {"type": object_type, "name_label": name}},
+                )
+                for object_type, name in lookups
+            ],
+            use_cache=True,
+        )
+        return [next(iter(objects), None) for objects in results]
 
     async def introspect(self) -> dict:
         return await self.ws.system.getMethodsInfo()
@@ -50,68 +170,126 @@ class XenOrchestraApi:
     async def list_srs(self) -> dict:
         return await self.ws.xo.getAllObjects(filter={"type": "SR"})
 
-    async def get_sr_by_name(self, name: str) -> Optional[dict]:
-        for sr_id, sr_info in (await self.list_srs()).items():
-            if sr_info["name_label"] == name:
-                return sr_id
-        return None
+    async def get_sr_by_name(self, name: str) -> Optional[str]:
+        # Shares the session cache with other lookups of the same SR
+        (sr_id,) = await self.get_objects_by_name([("SR", name)])
+        return sr_id
+
+    @staticmethod
+    async def __read_file_chunks(
+        file_path: Path,
+        file_size: int,
+        progress_callback: Optional[Callable[[float], None]] = None,
+    ) -> AsyncIterator[bytes]:
+        """
+        Read a file by chunks without blocking the event loop.
 
-    def import_disk(
+        Args:
+            file_path: Path to the file to read.
+            file_size: Size of the file, used to report progress.
+            progress_callback: Optional callback function to report progress (0.0 to 1.0).
+        """
+        bytes_read = 0
+        async with aiofiles.open(file_path, "rb") as file:
+            if hasattr(os, "posix_fadvise"):
+                # The file is read once from start to end, let the kernel
+                # read ahead more aggressively
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            # Keep the next read in flight while the current chunk is sent
+            next_chunk = asyncio.ensure_future(file.read(UPLOAD_CHUNK_SIZE))
+            try:
+                while chunk := await next_chunk:
+                    next_chunk = asyncio.ensure_future(file.read(UPLOAD_CHUNK_SIZE))
+                    bytes_read += len(chunk)
+                    if progress_callback:
+                        progress_callback(bytes_read / file_size)
+                    yield chunk
+            finally:
+                next_chunk.cancel()
+
+    async def import_disk(
         self,
         sr_id: str,
         file_path: Path,
         upload_name: str,
         progress_callback: Optional[Callable[[float], None]] = None,
-    ):
+        file_size: Optional[int] = None,
+    ) -> str:
         supported_formats = ["iso", "raw"]
         if file_path.suffix[1:] not in supported_formats:
             raise ValueError(
                 f"Unsupported file format. Supported formats are: {supported_formats}"
             )
 
-        upload_url = (
-            self.http_host
-            + f"/rest/v0/srs/{sr_id}/vdis"
-            + f"?raw&name_label={upload_name}"
+        upload_url = self._vdi_upload_url.format(
+            sr_id=quote(sr_id, safe=""), name=quote(upload_name, safe="")
         )
 
-        with file_path.open("rb") as file:
-            response = requests.post(
-                upload_url,
-                cookies=self.http_cookies,
-                headers={
-                    "Content-Type": "application/octet-stream",
-                    "Content-Length": str(file_path.stat().st_size),
-                },
-                data=BufferedReaderWithProgressCallback(
-                    file.raw, progress_callback=progress_callback
-                ),
-            )
-
-        if response.status_code == 200:
-            return response.text
+        # Callers that already know the size spare a stat of the image
+        if file_size is None:
+            file_size = (await asyncio.to_thread(file_path.stat)).st_size
+
+        # Stream the file so the upload neither loads the whole disk image in
+        # memory nor blocks the event loop
+        async with self.session.post(
+            upload_url,
+            cookies=self.http_cookies,
+            headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Length": str(file_size),
+            },
+            data=self.__read_file_chunks(file_path, file_size, progress_callback),
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_read=UPLOAD_SOCK_READ_TIMEOUT
+            ),
+        ) as response:
+            response_text = await response.text()
+
+        if response.status == 200:
+            return response_text
         else:
             raise Exception(
-                f"Failed to upload file: {response.status_code}, reason: {response.text}"
+                f"Failed to upload file: {response.status}, reason: {response_text}"
             )
 
     async def list_templates(self) -> dict:
         return await self.ws.xo.getAllObjects(filter={"type": "VM-template"})
 
-    async def get_template_by_name(self, name: str) -> Optional[dict]:
-        for template_id, template_info in (await self.list_templates()).items():
-            if template_info["name_label"] == name:
-                return template_id
-        return None
+    async def list_templates_cached(self, max_age: float = TEMPLATES_CACHE_TTL) -> dict:
+        """List templates, reusing a recent listing when available.
+
+        Concurrent callers share a single request. The cache is dropped
+        whenever a template is created or deleted through this API.
+
+        Args:
+            max_age: Maximum age in seconds of the cached listing
+
+        Returns:
+            dict: Templates indexed by ID
+        """
+        async with self._templates_lock:
+            if self._templates_cache is not None:
+                fetched_at, templates = self._templates_cache
+                if time.monotonic() - fetched_at < max_age:
+                    return templates
+
+            templates = await self.list_templates()
+            self._templates_cache = (time.monotonic(), templates)
+            return templates
+
+    async def get_template_by_name(self, name: str) -> Optional[str]:
+        # Shares the session cache with other lookups of the same template
+        (template_id,) = await self.get_objects_by_name([("VM-template", name)])
+        return template_id
 
     async def get_networks(self) -> dict:
         return await self.ws.xo.getAllObjects(filter={"type": "network"})
 
-    async def get_network_by_name(self, name: str) -> Optional[dict]:
-        for network_id, network_info in (await self.get_networks()).items():
-            if network_info["name_label"] == name:
-                return network_id
-        return None
+    async def get_network_by_name(self, name: str) -> Optional[str]:
+        # Shares the session cache with other lookups of the same network
+        (network_id,) = await self.get_objects_by_name([("network", name)])
+        return network_id
 
     async def create_vm(
         self,
@@ -122,7 +300,7 @@ class XenOrchestraApi:
         cpus: int = 1,
         memory: int = 1,
         bootAfterCreate: bool = False,
-        tags: Optional[list] = [],
+        tags: Sequence[str] = (),
     ) -> dict:
         # Validate parameters with Pydantic
         params = VmCreateParams(
@@ -133,19 +311,15 @@ class XenOrchestraApi:
             cpus=cpus,
             memory=memory,
             bootAfterCreate=bootAfterCreate,
-            tags=tags or [],
+            tags=tags,
         )
 
         return await self.ws.vm.create(
-            acls=[],
-            clone=False,
-            existingDisks={},
-            installation={"method": "network", "repository": "pxe"},
+            **VM_CREATE_DEFAULTS,
             bootAfterCreate=params.bootAfterCreate,
             name_label=params.name_label,
             name_description=params.name_description,
             template=params.template_id,
-            VDIs=[],
             VIFs=[
                 {
                     "network": params.network_id,
@@ -155,17 +329,8 @@ class XenOrchestraApi:
             ],
             CPUs=params.cpus,
             cpusMax=params.cpus,
-            cpuWeight=None,
-            cpuCap=None,
             memory=params.memory * 1024 * 1024 * 1024,
-            copyHostBiosStrings=True,
-            createVtpm=False,
-            destroyCloudConfigVdiAfterBoot=False,
-            secureBoot=False,
-            shared=False,
-            coreOs=False,
             tags=params.tags,
-            hvmBootFirmware="uefi",
         )
 
     async def attach_vdi_to_vm(
@@ -219,9 +384,11 @@ class XenOrchestraApi:
         self,
         vm_id: str,
     ) -> bool:
-        return await self.ws.vm.convertToTemplate(
+        result = await self.ws.vm.convertToTemplate(
             id=vm_id,
         )
+        self._templates_cache = None
+        return result
 
     async def delete_template(
         self,
@@ -235,6 +402,24 @@ class XenOrchestraApi:
         Returns:
             bool: True if successful, raises an exception otherwise
         """
-        return await self.ws.vm.delete(
+        result = await self.ws.vm.delete(
             id=template_id,
         )
+        self._templates_cache = None
+        return result
+
+    async def delete_templates(self, template_ids: list[str]) -> list:
+        """Delete several templates in a single batch.
+
+        Args:
+            template_ids: The IDs of the templates to delete
+
+        Returns:
+            list: For each template, True if successful or the raised exception
+        """
+        results = await self.call_batch(
+            [("vm.delete", {"id": template_id}) for template_id in template_ids],
+            return_exceptions=True,
+        )
+        self._templates_cache = None
+        return results
@@ -1,35 +1,84 @@
+import asyncio
+
+import aiohttp
+
 from ..tools import logger
 from .api import XenOrchestraApi
 
+# Connection pool shared by the websocket and the REST calls of a session
+HTTP_LIMIT_PER_HOST = 8
+HTTP_KEEPALIVE_TIMEOUT = 60
+# Seconds to keep resolved addresses of the Xen Orchestra host
+HTTP_DNS_CACHE_TTL = 300
+# Upper bound, in seconds, for the websocket connect and login handshake
+HANDSHAKE_TIMEOUT = 30
+
 
 class AsyncAPISession:
     """Context manager for Xen Orchestra API session."""
 
-    def __init__(self, api: XenOrchestraApi):
+    def __init__(
+        self, api: XenOrchestraApi, concurrency: int = 1, log_errors: bool = True
+    ):
+        """
+        Args:
+            api: Xen Orchestra API client to connect
+            concurrency: Number of templates that will use the session at once
+            log_errors: Log a failure to open the session, callers that
+                report the raised exception themselves can turn it off
+        """
         self.api = api
+        self.log_errors = log_errors
+        # Each concurrent template may hold a connection for its disk upload,
+        # on top of the one used by the websocket
+        self.limit_per_host = max(HTTP_LIMIT_PER_HOST, concurrency + 1)
 
     async def __aenter__(self):
+        # A single long-lived HTTP session so every call reuses pooled
+        # keep-alive connections instead of paying a new TCP/TLS handshake
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            )
+        )
         try:
-            await self.api.connect()
-            logger.debug("Connected to Xen Orchestra.")
-
-            logger.debug("Logging in...")
-            await self.api.login()
-            logger.debug("Logged in.")
-
+            # Fail fast on an unreachable host instead of hanging the CLI
+            try:
+                await asyncio.wait_for(self.__handshake(), timeout=HANDSHAKE_TIMEOUT)
+            except asyncio.TimeoutError:
+                # The timeout raised by wait_for has no message
+                raise asyncio.TimeoutError(
+                    f"Timed out connecting to {self.api.host} after {HANDSHAKE_TIMEOUT} s"
+                ) from None
             return self.api
-        except Exception as e:
-            logger.error(f"Failed to establish API session: {e}")
+        except BaseException as e:
+            # Also clean up when the handshake is cancelled midway
+            if self.log_errors and not isinstance(e, asyncio.CancelledError):
+                logger.error("Failed to establish API session: %s", e)
             # Make sure to disconnect if connect succeeded but login failed
             try:
                 await self.api.disconnect()
             except:
                 pass
+            await self.session.close()
             raise
 
+    async def __handshake(self):
+        """Connect to Xen Orchestra and authenticate the websocket."""
+        await self.api.connect(self.session)
+        logger.debug("Connected to Xen Orchestra.")
+
+        logger.debug("Logging in...")
+        await self.api.login()
+        logger.debug("Logged in.")
+
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         try:
             await self.api.disconnect()
             logger.debug("Disconnected from Xen Orchestra.")
         except Exception as e:
-            logger.error(f"Error disconnecting from API: {e}")
+            logger.error("Error disconnecting from API: %s", e)
+        finally:
+            await self.session.close()
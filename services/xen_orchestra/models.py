@@ -27,7 +27,7 @@ class BootOrderParams(BaseModel):
 
     @field_validator("boot_order")
     def validate_boot_order(cls, v):
-        allowed_chars = set("cdn")
-        if not all(c in allowed_chars for c in v):
+        # Stripping the allowed characters leaves nothing only if all are
+        if v.strip("cdn"):
             raise ValueError("Boot order can only contain 'c', 'd', or 'n' characters")
         return v